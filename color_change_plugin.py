@@ -17,11 +17,28 @@
 
 #!/usr/bin/env python3
 import argparse
+import itertools
 import math
 import re
 import logging
 import os
+import stat
 import sys
+import tempfile
+
+# Compiled once at import; the search helpers below are called for every G-code line.
+# E and F values are digits with an optional fraction, or a bare fraction (PrusaSlicer writes E.02783
+# for sub-millimetre moves); E may also be negative.
+_E_RE = re.compile(r'(?<=\s)E(-?(?:\d+\.?\d*|\.\d+))')
+_F_RE = re.compile(r'F(\d+\.?\d*|\.\d+)')
+_SPOOL_NUM_RE = re.compile(r'(\d+(\.\d+)?)')
+_AXIS_RES = {'E': _E_RE, 'F': _F_RE}
+
+# Output is written through a 1 MiB buffer.
+_WRITE_BUFFER_SIZE = 1 << 20
+# The spool weight is searched for in this many leading lines and in this many trailing bytes.
+_HEADER_LINES = 200
+_TAIL_BYTES = 16 * 1024
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -63,40 +80,241 @@ def setup_logging(debug):
     if debug:
         logging.debug("Debug mode enabled.")
 
+def _parse_axis(line, axis):
+    """
+    Returns the value of the first match of the axis pattern for `axis` ('E' or 'F') in a G-code
+    line, or None if there is none. The pattern is tried in place at the first occurrence of the
+    letter, which is the parameter itself on a typical move line, and only searched for past it.
+    """
+    start = line.find(axis)
+    if start < 0:
+        return None
+    pattern = _AXIS_RES[axis]
+    match = pattern.match(line, start) or pattern.search(line, start + 1)
+    return float(match.group(1)) if match else None
+
 def extract_extrusion_value(line):
     """
     Extracts the value following the 'E' parameter in a G-code line.
     """
-    match = re.search(r'(?<=\sE)(-?\d+\.?\d*)', line)
-    if match:
-        try:
-            return float(match.group(0))
-        except ValueError:
-            return 0.0
-    return 0.0
+    e_value = _parse_axis(line, 'E')
+    return 0.0 if e_value is None else e_value
 
-def extract_spool_weight_from_header(lines):
+def extract_spool_weight_from_header(path):
     """
-    Attempts to parse the spool weight from the G-code header.
-    Looks for a comment line containing 'spool weight'.
+    Attempts to parse the spool weight from the header of the G-code file at `path`.
+    Looks for a comment line containing 'spool weight' in the first _HEADER_LINES lines and then in
+    the file's last _TAIL_BYTES (slicers write their settings at either end of the file).
+    """
+    with open(path, 'r', encoding='utf-8', errors='surrogateescape') as f:
+        weight = _find_spool_weight(itertools.islice(f, _HEADER_LINES))
+    if weight is None:
+        weight = _find_spool_weight(_read_tail_lines(path))
+    if weight is None:
+        logging.debug("No spool weight found in header.")
+    return weight
+
+def _find_spool_weight(lines):
+    """
+    Returns the spool weight in grams from the first 'spool weight' comment among `lines`, or None.
     """
     for line in lines:
         if "spool weight" in line.lower():
-            match = re.search(r'(\d+(\.\d+)?)', line)
+            match = _SPOOL_NUM_RE.search(line)
             if match:
                 weight = float(match.group(1))
                 if 'kg' in line.lower():
                     weight *= 1000  # Convert kg to grams.
                 logging.debug("Extracted spool weight: %sg from line: %s", weight, line.strip())
                 return weight
-    logging.debug("No spool weight found in header.")
     return None
 
+def _read_tail_lines(path, size=_TAIL_BYTES):
+    """
+    Returns the complete lines within the last `size` bytes of the file at `path`.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        start = max(0, f.tell() - size)
+        f.seek(start)
+        lines = f.read().decode('utf-8', errors='surrogateescape').splitlines()
+    # The first line is cut off unless the read started at the beginning of the file.
+    return lines[1:] if start > 0 else lines
+
+def _ends_with_newline(path):
+    """
+    Returns True if the file at `path` is empty or its last byte is a newline.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+def _output_mode(path):
+    """
+    Returns the permission bits to give the output file at `path`: those of the existing file, or
+    the default for a new file (0o666 less the umask).
+    """
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+def _process_relative(lines, conv, trigger_weight, trigger_length, cc_line, cc_line_layer,
+                      feedrate_threshold, debug, debug_interval, layer_based):
+    """
+    process_gcode loop for relative extrusion: each E value is the delta itself and G92 resets can be
+    skipped without parsing.
+    Keep in step with _process_absolute.
+    """
+    extruded = 0.0                 # Total extruded length (never reset)
+    next_trigger = trigger_length  # Extruded length at which the next color change is due
+    # Bound to locals for the per-line calls.
+    parse_axis = _parse_axis
+    log_debug = logging.debug
+    next_debug_idx = 0  # Start of the next debug_interval window; the modulo runs once per window
+    insertions = []
+
+    for idx, line in enumerate(lines):
+        # Prefix tests work on the raw line; only an indented line is stripped first.
+        head = line[:1]
+        if head == ' ' or head == '\t':
+            stripped_line = line.strip()
+            head = stripped_line[:1]
+        else:
+            stripped_line = line
+
+        if head == 'G':
+            # Count G1 moves with extrusion (E) only if the line contains at least one X, Y, or Z
+            # coordinate and its feedrate does not exceed the threshold.
+            if (stripped_line.startswith("G1") and "E" in stripped_line
+                    and ("X" in stripped_line or "Y" in stripped_line or "Z" in stripped_line)):
+                extrusion_delta, feedrate = parse_axis(stripped_line, 'E'), parse_axis(stripped_line, 'F')
+                if ((feedrate is None or feedrate <= feedrate_threshold)
+                        and extrusion_delta is not None and extrusion_delta > 0):
+                    extruded += extrusion_delta
+
+                    if debug and idx >= next_debug_idx:
+                        offset = idx % debug_interval
+                        if offset == 0:
+                            log_debug("Line %d: Extrusion delta: %.4f mm, Weight delta: %.6fg, Cumulative weight: %.2fg",
+                                      idx, extrusion_delta, extrusion_delta * conv,
+                                      (extruded - next_trigger + trigger_length) * conv)
+                        next_debug_idx = idx - offset + debug_interval
+
+                    if not layer_based and extruded >= next_trigger:
+                        # A single move may cross several thresholds.
+                        count = int((extruded - next_trigger) // trigger_length) + 1
+                        if debug:
+                            log_debug("Inserting %d color change command(s) at cumulative weight: %.2fg (Threshold: %.2fg)",
+                                      count, (extruded - next_trigger + trigger_length) * conv, trigger_weight)
+                        insertions.append((idx, cc_line * count))
+                        next_trigger += count * trigger_length
+
+        elif head == ';':
+            # Layer-based mode: check for layer marker (adjust marker if needed)
+            if layer_based and extruded >= next_trigger and stripped_line.startswith("; layer"):
+                if debug:
+                    log_debug("Layer-based insertion at line %d: cumulative weight %.2fg exceeds threshold %.2fg",
+                              idx, (extruded - next_trigger + trigger_length) * conv, trigger_weight)
+                insertions.append((idx, cc_line_layer))
+                next_trigger += trigger_length
+
+    return insertions, _report_totals(extruded, next_trigger, trigger_length, conv, debug)
+
+def _process_absolute(lines, conv, trigger_weight, trigger_length, cc_line, cc_line_layer,
+                      feedrate_threshold, debug, debug_interval, layer_based):
+    """
+    process_gcode loop for absolute extrusion: deltas are taken against the previous E value, which
+    G92 commands reset.
+    Keep in step with _process_relative.
+    """
+    extruded = 0.0                 # Total extruded length (never reset)
+    next_trigger = trigger_length  # Extruded length at which the next color change is due
+    last_extrusion = 0.0
+    # Bound to locals for the per-line calls.
+    parse_axis = _parse_axis
+    log_debug = logging.debug
+    next_debug_idx = 0  # Start of the next debug_interval window; the modulo runs once per window
+    insertions = []
+
+    for idx, line in enumerate(lines):
+        # Prefix tests work on the raw line; only an indented line is stripped first.
+        head = line[:1]
+        if head == ' ' or head == '\t':
+            stripped_line = line.strip()
+            head = stripped_line[:1]
+        else:
+            stripped_line = line
+
+        if head == 'G':
+            # Count G1 moves with extrusion (E) only if the line contains at least one X, Y, or Z
+            # coordinate and its feedrate does not exceed the threshold.
+            if (stripped_line.startswith("G1") and "E" in stripped_line
+                    and ("X" in stripped_line or "Y" in stripped_line or "Z" in stripped_line)):
+                e_value, feedrate = parse_axis(stripped_line, 'E'), parse_axis(stripped_line, 'F')
+                if feedrate is None or feedrate <= feedrate_threshold:
+                    if e_value is None:
+                        e_value = 0.0
+                    extrusion_delta = e_value - last_extrusion
+                    last_extrusion = e_value
+
+                    if extrusion_delta > 0:
+                        extruded += extrusion_delta
+
+                        if debug and idx >= next_debug_idx:
+                            offset = idx % debug_interval
+                            if offset == 0:
+                                log_debug("Line %d: Extrusion delta: %.4f mm, Weight delta: %.6fg, Cumulative weight: %.2fg",
+                                          idx, extrusion_delta, extrusion_delta * conv,
+                                          (extruded - next_trigger + trigger_length) * conv)
+                            next_debug_idx = idx - offset + debug_interval
+
+                        if not layer_based and extruded >= next_trigger:
+                            # A single move may cross several thresholds.
+                            count = int((extruded - next_trigger) // trigger_length) + 1
+                            if debug:
+                                log_debug("Inserting %d color change command(s) at cumulative weight: %.2fg (Threshold: %.2fg)",
+                                          count, (extruded - next_trigger + trigger_length) * conv, trigger_weight)
+                            insertions.append((idx, cc_line * count))
+                            next_trigger += count * trigger_length
+
+            # Handle G92 commands that reset the extrusion counter.
+            elif stripped_line.startswith("G92") and "E" in stripped_line:
+                e_value = extract_extrusion_value(stripped_line)
+                last_extrusion = e_value
+                if debug:
+                    log_debug("G92 command at line %d: resetting last_extrusion to %.4f", idx, e_value)
+
+        elif head == ';':
+            # Layer-based mode: check for layer marker (adjust marker if needed)
+            if layer_based and extruded >= next_trigger and stripped_line.startswith("; layer"):
+                if debug:
+                    log_debug("Layer-based insertion at line %d: cumulative weight %.2fg exceeds threshold %.2fg",
+                              idx, (extruded - next_trigger + trigger_length) * conv, trigger_weight)
+                insertions.append((idx, cc_line_layer))
+                next_trigger += trigger_length
+
+    return insertions, _report_totals(extruded, next_trigger, trigger_length, conv, debug)
+
+def _report_totals(extruded, next_trigger, trigger_length, conv, debug):
+    total_weight = extruded * conv
+    if debug:
+        logging.debug("Final cumulative weight: %.2fg", (extruded - next_trigger + trigger_length) * conv)
+        logging.debug("Total filament weight used (model): %.2fg", total_weight)
+    return total_weight
+
 def process_gcode(lines, spool_weight, conversion_factor, extrusion_mode,
                   color_change_command, safety_margin, feedrate_threshold,
                   scale, debug, debug_interval, layer_based=False):
     """
-    Processes the G-code file.
+    Scans the G-code lines and returns `(insertions, total_weight)`, where `insertions` is a list of
+    `(line_index, text)` pairs, in line order, giving the color change lines to write before the input
+    line at that index (see write_gcode). The input is read once and never held in memory.
     
     In non-layer-based mode, the script inserts the color change command immediately when the cumulative
     extruded filament reaches the threshold. In layer-based mode, it waits for a layer change marker
@@ -104,92 +322,50 @@ def process_gcode(lines, spool_weight, conversion_factor, extrusion_mode,
     
     Also calculates the total filament weight used by summing extrusion moves (only counting those moves that
     have at least one X, Y, or Z coordinate and a feedrate below the threshold). The computed weight is scaled
-    by the given factor.
+    by the given factor. Raises ValueError if spool_weight * (1 - safety_margin) is not positive.
     """
-    new_lines = []
-    cumulative_weight = 0.0  # For threshold checking (this resets after each insertion)
-    total_weight = 0.0       # Total extruded weight (never reset)
     # Apply scale factor to the conversion factor
     conv = conversion_factor * scale
     trigger_weight = spool_weight * (1 - safety_margin)
-    last_extrusion = 0.0  # Used for absolute mode
-
-    for idx, line in enumerate(lines):
-        stripped_line = line.strip()
-
-        # Layer-based mode: check for layer marker (adjust marker if needed)
-        if layer_based and stripped_line.startswith("; layer"):
-            if cumulative_weight >= trigger_weight:
-                logging.debug("Layer-based insertion at line %d: cumulative weight %.2fg exceeds threshold %.2fg",
-                              idx, cumulative_weight, trigger_weight)
-                new_lines.append(f"{color_change_command} ; Color change triggered after ~{trigger_weight:.2f}g used at layer change")
-                cumulative_weight -= trigger_weight
-            new_lines.append(line.rstrip('\n'))
-            continue
-
-        # Handle G92 commands that reset the extrusion counter.
-        if stripped_line.startswith("G92") and "E" in stripped_line:
-            e_value = extract_extrusion_value(stripped_line)
-            last_extrusion = e_value
-            logging.debug("G92 command at line %d: resetting last_extrusion to %.4f", idx, e_value)
-            new_lines.append(line.rstrip('\n'))
-            continue
-
-        # Process G1 moves with extrusion (E) only if the line contains at least one X, Y, or Z coordinate.
-        if stripped_line.startswith("G1") and "E" in stripped_line:
-            if not any(axis in stripped_line for axis in ("X", "Y", "Z")):
-                new_lines.append(line.rstrip('\n'))
-                continue
-
-            # Check for a feedrate and skip moves with feedrate above the threshold.
-            feedrate_match = re.search(r'F(\d+\.?\d*)', stripped_line)
-            if feedrate_match:
-                feedrate = float(feedrate_match.group(1))
-                if feedrate > feedrate_threshold:
-                    new_lines.append(line.rstrip('\n'))
-                    continue
-
-            e_value = extract_extrusion_value(stripped_line)
-            if extrusion_mode == 'relative':
-                extrusion_delta = e_value
-            else:
-                extrusion_delta = e_value - last_extrusion
-                last_extrusion = e_value
-
-            if extrusion_delta > 0:
-                weight_delta = extrusion_delta * conv
-                cumulative_weight += weight_delta
-                total_weight += weight_delta
-
-                if debug and (idx % debug_interval == 0):
-                    logging.debug("Line %d: Extrusion delta: %.4f mm, Weight delta: %.6fg, Cumulative weight: %.2fg",
-                                  idx, extrusion_delta, weight_delta, cumulative_weight)
-
-                if not layer_based:
-                    while cumulative_weight >= trigger_weight:
-                        logging.debug("Inserting color change command at cumulative weight: %.2fg (Threshold: %.2fg)",
-                                      cumulative_weight, trigger_weight)
-                        new_lines.append(f"{color_change_command} ; Color change triggered after ~{trigger_weight:.2f}g used")
-                        cumulative_weight -= trigger_weight
+    if trigger_weight <= 0:
+        raise ValueError("No filament is left to use before a color change: spool_weight must be positive "
+                         f"and safety_margin below 1 (got {spool_weight} and {safety_margin})")
+    # Extrusion is accumulated as filament length (mm) in a single running sum and only converted to
+    # grams when reported, so each counted move costs one addition.
+    trigger_length = trigger_weight / conv if conv > 0 else math.inf
+    # The inserted lines are the same every time, so they are formatted once here.
+    cc_line = f"{color_change_command} ; Color change triggered after ~{trigger_weight:.2f}g used"
+    cc_line_layer = cc_line + " at layer change\n"
+    cc_line += "\n"
+    # All of the scan's debug output is keyed off this one flag.
+    debug = debug and logging.getLogger().isEnabledFor(logging.DEBUG)
+    # The extrusion mode is fixed for the whole file, so each mode has its own loop.
+    process = _process_relative if extrusion_mode == 'relative' else _process_absolute
+    return process(lines, conv, trigger_weight, trigger_length, cc_line, cc_line_layer,
+                   feedrate_threshold, debug, debug_interval, layer_based)
 
-        new_lines.append(line.rstrip('\n'))
-
-    if debug:
-        logging.debug("Final cumulative weight: %.2fg", cumulative_weight)
-        logging.debug("Total filament weight used (model): %.2fg", total_weight)
-    return new_lines, total_weight
+def write_gcode(lines, out, insertions):
+    """
+    Writes the G-code lines to the file `out`, with the text of each `(line_index, text)` insertion
+    written just before the line at that index. The lines in between are copied unchanged with
+    writelines(), so the copy never runs Python code per line.
+    """
+    lines = iter(lines)
+    written = 0
+    for line_index, text in insertions:
+        out.writelines(itertools.islice(lines, line_index - written))
+        out.write(text)
+        written = line_index
+    out.writelines(lines)
 
 def main():
     try:
         args = parse_arguments()
         setup_logging(args.debug)
 
-        with open(args.input, 'r') as f:
-            lines = f.readlines()
-
         spool_weight = args.spool_weight
         if spool_weight is None:
-            spool_weight = extract_spool_weight_from_header(lines)
+            spool_weight = extract_spool_weight_from_header(args.input)
             if spool_weight is None:
                 logging.error("Spool weight not provided and not found in G-code header. Please supply --spool_weight.")
                 sys.exit(2)
@@ -199,30 +375,46 @@ def main():
         conversion_factor = (area * args.filament_density) / 1000.0
         logging.debug("Calculated filament area: %.6f mm², Conversion factor: %.6f g/mm", area, conversion_factor)
 
-        processed_lines, total_weight = process_gcode(
-            lines,
-            spool_weight=spool_weight,
-            conversion_factor=conversion_factor,
-            extrusion_mode=args.extrusion_mode,
-            color_change_command=args.color_change_command,
-            safety_margin=args.safety_margin,
-            feedrate_threshold=args.feedrate_threshold,
-            scale=args.scale,
-            debug=args.debug,
-            debug_interval=args.debug_interval,
-            layer_based=args.layer_based
-        )
-
-        # Append a comment line with the total filament weight used.
-        processed_lines.append(f"; TOTAL FILAMENT WEIGHT USED: {total_weight:.2f}g")
+        # UTF-8 with surrogateescape, so any non-UTF-8 bytes in comments are written back out unchanged.
+        with open(args.input, 'r', encoding='utf-8', errors='surrogateescape') as fi:
+            insertions, total_weight = process_gcode(
+                fi,
+                spool_weight=spool_weight,
+                conversion_factor=conversion_factor,
+                extrusion_mode=args.extrusion_mode,
+                color_change_command=args.color_change_command,
+                safety_margin=args.safety_margin,
+                feedrate_threshold=args.feedrate_threshold,
+                scale=args.scale,
+                debug=args.debug,
+                debug_interval=args.debug_interval,
+                layer_based=args.layer_based
+            )
 
+        # Second pass: copy the input through, adding the color changes found by the scan. The output
+        # goes to a fresh temporary file next to it first, so that --output may name the input file
+        # itself; the temporary file is removed if anything fails (or is interrupted) before the rename.
         output_dir = os.path.dirname(args.output)
-        if output_dir and not os.path.exists(output_dir):
+        if output_dir:
             os.makedirs(output_dir, exist_ok=True)
+        fd, temp_output = tempfile.mkstemp(suffix=".tmp", dir=output_dir or '.')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8', errors='surrogateescape',
+                           buffering=_WRITE_BUFFER_SIZE) as fo, \
+                    open(args.input, 'r', encoding='utf-8', errors='surrogateescape') as fi:
+                write_gcode(fi, fo, insertions)
 
-        with open(args.output, 'w') as f:
-            for line in processed_lines:
-                f.write(line + "\n")
+                # The input's last line may have no newline; keep the footer on a line of its own.
+                if not _ends_with_newline(args.input):
+                    fo.write("\n")
+                # Append a comment line with the total filament weight used.
+                fo.write(f"; TOTAL FILAMENT WEIGHT USED: {total_weight:.2f}g\n")
+            # mkstemp creates the file owner-only; give it the mode writing the output directly would.
+            os.chmod(temp_output, _output_mode(args.output))
+            os.replace(temp_output, args.output)
+        except BaseException:
+            os.remove(temp_output)
+            raise
 
         logging.info("Processed G-code has been saved to %s", args.output)
         logging.info("Total filament weight used for model: %.2fg", total_weight)